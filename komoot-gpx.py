@@ -1,10 +1,19 @@
 import getopt
+import logging
 import os
 import sys
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from itertools import islice
 
 import colorama
 
-from komootgpx.api import KomootApi
+from komootgpx.api import KomootApi, QueryFilter, TourDetails
 from komootgpx.gpxcompiler import GpxCompiler
 from komootgpx.utils import (
     bcolor,
@@ -17,9 +26,17 @@ from komootgpx.utils import (
 
 colorama.init()
 
+# number of tours fetched concurrently when downloading all tours
+MAX_WORKERS = 8
+
 
 def usage():
     print(bcolor.HEADER + bcolor.BOLD + "komoot-gpx.py [options]" + bcolor.ENDC)
+    print(
+        "\t{:<2s}, {:<30s} {:<10s}".format(
+            "-v", "--verbose", "Show progress messages"
+        )
+    )
     print(bcolor.OKBLUE + "[Authentication]" + bcolor.ENDC)
     print(
         "\t{:<2s}, {:<30s} {:<10s}".format(
@@ -70,17 +87,140 @@ def usage():
             "-e", "--no-poi", "Do not include highlights as POIs"
         )
     )
+    print(
+        "\t{:<2s}, {:<30s} {:<10s}".format(
+            "-F",
+            "--fast",
+            "Save the GPX track rendered by komoot as is (faster, less metadata)",
+        )
+    )
+    print(
+        "\t{:<2s}, {:<30s} {:<10s}".format(
+            "-E",
+            "--full-embed",
+            "Also download way types, surfaces, directions and timeline of tours",
+        )
+    )
 
 
 def make_gpx(tour, output_dir):
     gpx = GpxCompiler(tour.json_data)
 
-    path = f"{output_dir}/{sanitize_filename(tour.json_data['name'])}-{tour.id}.gpx"
-    f = open(path, "w", encoding="utf-8")
-    f.write(gpx.generate())
-    f.close()
+    name = sanitize_filename(tour.json_data["name"])
+    path = os.path.join(output_dir, f"{name}-{tour.id}.gpx")
+
+    # write to a temporary file first, so an interrupted run never leaves a
+    # truncated GPX file behind
+    tmp_path = path + ".tmp"
+    # opened outside of the try block, so there is nothing to clean up if
+    # the file can't be created
+    f = open(tmp_path, "w", encoding="utf-8")
+    try:
+        with f:
+            gpx.generate_to_stream(f)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+    return path
+
 
-    print_success(f"GPX file written to '{path}'")
+def tour_name(tour):
+    """Returns the name of a tour returned by `KomootApi.fetch_tours`, which is
+    either a `TourDetails` instance or the raw tour data."""
+    return tour.name if isinstance(tour, TourDetails) else tour["name"]
+
+
+def make_gpx_fast(api, tour_id, name, output_dir):
+    path = os.path.join(output_dir, f"{sanitize_filename(name)}-{tour_id}.gpx")
+    tmp_path = path + ".tmp"
+    f = open(tmp_path, "wb")
+    try:
+        with f:
+            written = api.write_tour_gpx(tour_id, f)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if not written:
+        # access to the tour was denied, which the API has already reported
+        os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def print_written(path):
+    # status lines are only printed from the main thread, so the output of
+    # concurrent downloads doesn't interleave
+    if path is not None:
+        print_success(f"GPX file written to '{path}'")
+
+
+def download_all(
+    api, tours, output_dir, fast=False, full_embed=False, max_workers=MAX_WORKERS
+):
+    """Fetches the given tours concurrently and writes each one as a GPX file
+    as soon as it has been downloaded.
+
+    Fetching a tour is dominated by waiting on the Komoot API, so the requests
+    are dispatched from a thread pool instead of one after another. Compiling
+    the GPX files is CPU bound pure Python code, so it is handed to a process
+    pool as each tour arrives, where it isn't serialised by the GIL.
+    Only `max_workers` tours are in flight at once, so memory use does not grow
+    with the number of tours.
+
+    Args:
+        api (KomootApi): Logged in API instance.
+        tours (dict): Tours to download as returned by `KomootApi.fetch_tours`,
+            with the tour id as key.
+        output_dir (str): Directory the GPX files are written to.
+        fast (bool, optional): Save the GPX track rendered by komoot instead of
+            compiling it from the tour data. Defaults to False.
+        full_embed (bool, optional): Also download way types, surfaces,
+            directions and the timeline of the tours. Defaults to False.
+        max_workers (int, optional): Maximum number of concurrent requests.
+            Defaults to MAX_WORKERS.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if fast:
+            futures = [
+                executor.submit(
+                    make_gpx_fast, api, tour_id, tour_name(tours[tour_id]), output_dir
+                )
+                for tour_id in tours
+            ]
+            for future in as_completed(futures):
+                print_written(future.result())
+        else:
+            # at most `max_workers` tours are fetched or written at a time, so
+            # only that many parsed tours are held in memory. Another tour is
+            # fetched whenever a GPX file has been written or a tour skipped.
+            tour_ids = iter(tours)
+            fetches = {
+                executor.submit(api.fetch_tour, tour_id, full_embed)
+                for tour_id in islice(tour_ids, max_workers)
+            }
+            writes = set()
+            with ProcessPoolExecutor() as processes:
+                while fetches or writes:
+                    done, _ = wait(fetches | writes, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in fetches:
+                            fetches.remove(future)
+                            tour = future.result()
+                            # tours komoot denied access to are skipped
+                            if tour is not None:
+                                writes.add(processes.submit(make_gpx, tour, output_dir))
+                                continue
+                        else:
+                            writes.remove(future)
+                            print_written(future.result())
+                        for tour_id in islice(tour_ids, 1):
+                            fetches.add(
+                                executor.submit(api.fetch_tour, tour_id, full_embed)
+                            )
 
 
 def main(argv):
@@ -88,13 +228,17 @@ def main(argv):
     mail = ""
     pwd = ""
     user_id = ""
+    tour_type = None
     print_tours = False
+    fast = False
+    full_embed = False
+    log_level = logging.WARNING
     output_dir = os.getcwd()
 
     try:
         opts, args = getopt.getopt(
             argv,
-            "hlo:d:m:p:f:u:",
+            "hvlo:d:m:p:f:u:FE",
             [
                 "list-tours",
                 "make-gpx=",
@@ -104,6 +248,9 @@ def main(argv):
                 "filter=",
                 "output=",
                 "make-all",
+                "fast",
+                "full-embed",
+                "verbose",
             ],
         )
     except getopt.GetoptError:
@@ -115,6 +262,9 @@ def main(argv):
             usage()
             sys.exit()
 
+        elif opt in ("-v", "--verbose"):
+            log_level = logging.INFO
+
         elif opt in ("-l", "--list-tours"):
             print_tours = True
 
@@ -130,12 +280,28 @@ def main(argv):
         elif opt in ("-u", "--user"):
             user_id = str(arg)
 
+        elif opt in ("-f", "--filter"):
+            if arg not in ("planned", "recorded"):
+                print_error('Invalid filter, use either "planned" or "recorded"')
+                sys.exit(2)
+            tour_type = f"tour_{arg}"
+
         elif opt in ("-o", "--output"):
             output_dir = str(arg)
 
         elif opt in ("-a", "--make-all"):
             tour_selection = "all"
 
+        elif opt in ("-F", "--fast"):
+            fast = True
+
+        elif opt in ("-E", "--full-embed"):
+            full_embed = True
+
+    # progress messages of the API go to stderr, so they neither mix with nor
+    # block on the tour list printed to stdout
+    logging.basicConfig(level=log_level, format="%(message)s")
+
     if mail == "":
         mail = prompt("Enter your mail address (komoot.de)")
 
@@ -152,9 +318,15 @@ def main(argv):
     if user_id == "":
         user_id = None
 
-    # fetch all tours of the user
-    tours = api.fetch_tours(user_id)
-    api.print_tours(tours)
+    # fetch all tours of the user. Filtering by type is done by the komoot API,
+    # so pages of tours that would be discarded are never downloaded.
+    queryfilter = QueryFilter(type=tour_type) if tour_type else None
+    # the tour details are only needed to list the tours. When downloading
+    # tours that were selected on the command line, the raw tour data will do.
+    list_tours = print_tours or tour_selection == ""
+    tours = api.fetch_tours(user_id, queryfilter, details=list_tours)
+    if list_tours:
+        api.print_tours(tours)
     print(f"Found {len(tours)} tours.")
 
     # exit in case just the tours should be printed
@@ -170,16 +342,22 @@ def main(argv):
         print_error(
             "Unknown tour id selected. These are all available tours on the profile:"
         )
+        if not list_tours:
+            tours = api.fetch_tours(user_id, queryfilter)
         api.print_tours(tours)
         exit(0)
 
     if tour_selection == "all":
-        for tour_id in tours:
-            tour = api.fetch_tour(tour_id)
-            make_gpx(tour, output_dir)
+        download_all(api, tours, output_dir, fast, full_embed)
+    elif fast:
+        tour_id = int(tour_selection)
+        print_written(
+            make_gpx_fast(api, tour_id, tour_name(tours[tour_id]), output_dir)
+        )
     else:
-        tour = api.fetch_tour(tour_selection)
-        make_gpx(tour, output_dir)
+        tour = api.fetch_tour(tour_selection, full_embed)
+        if tour is not None:
+            print_written(make_gpx(tour, output_dir))
     print()
 
 
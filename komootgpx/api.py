@@ -1,14 +1,90 @@
 import base64
+import json
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
-from dataclasses import dataclass, asdict, field
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+from dataclasses import dataclass, fields
 from datetime import timedelta, datetime
+from itertools import islice
 from gpxpy.geo import Location
 import typing
 
-
+from komootgpx.cache import TourCache
+
+logger = logging.getLogger(__name__)
+
+# orjson is optional, see the `fast` extra in setup.py. It builds Python objects
+# considerably faster than the standard library for the large, number heavy
+# tour responses.
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# base URLs of the komoot API
+API_URL = "https://api.komoot.de"
+API_V6 = f"{API_URL}/v006"
+API_V7 = f"{API_URL}/v007"
+
+# URL templates of a single tour, to be filled in with the tour id. By default
+# only the coordinates are embedded, as that is all `GpxCompiler` uses.
+TOUR_URL = API_V7 + "/tours/{}?_embedded=coordinates"
+# some of these query parameters are no longer supported.
+# The only supported ones are in _embedded:
+# coordinates, way_types, surfaces, directions, participants
+# Not supported:
+# timeline, directions, fields, format, timeline_highlights_fields, recommenders
+TOUR_URL_FULL_EMBED = (
+    API_V7 + "/tours/{}"
+    "?_embedded=coordinates,way_types,"
+    "surfaces,directions,participants,"
+    "timeline&directions=v2&fields"
+    "=timeline&format=coordinate_array"
+    "&timeline_highlights_fields=tips,"
+    "recommenders"
+)
+
+# (connect, read) timeout in seconds for requests to the komoot API
+REQUEST_TIMEOUT = (5, 30)
+
+# number of result pages fetched ahead, and concurrently, when walking
+# paginated endpoints
+PAGE_WORKERS = 8
+
+# number of tours fetched concurrently by `KomootApi.fetch_tours_bulk`
+TOUR_WORKERS = 8
+
+# size in bytes of the chunks a streamed GPX track is written in
+GPX_CHUNK_SIZE = 64 * 1024
+
+
+# The dataclasses that are created per tour or highlight declare `__slots__`,
+# so their instances don't carry a `__dict__`. `@dataclass(slots=True)` would
+# require Python 3.10. Derived values are properties, as a slot can't have
+# a class level default.
 @dataclass
 class TourDetails:
+    __slots__ = (
+        "id",
+        "name",
+        "date",
+        "sport",
+        "distance",
+        "duration",
+        "elevation_up",
+        "elevation_down",
+        "tourtype",
+        "user_id",
+        "user_display_name",
+    )
+
     id: int
     name: str
     date: datetime
@@ -20,7 +96,6 @@ class TourDetails:
     tourtype: str
     user_id: int
     user_display_name: str
-    link: str = field(init=False)
     outputfields: typing.ClassVar = [
             "id",
             "name",
@@ -33,8 +108,14 @@ class TourDetails:
             "link",
         ]
 
-    def __post_init__(self) -> None:
-        self.link = f'https://www.komoot.de/tour/{self.id}'
+    @property
+    def link(self) -> str:
+        """Returns the link to the tour on komoot.
+
+        Returns:
+            str: URL of the tour
+        """
+        return f'https://www.komoot.de/tour/{self.id}'
 
     def __repr__(self):
         return (
@@ -125,27 +206,38 @@ class TourDetails:
 
 @dataclass
 class Tour:
+    __slots__ = ("id", "json_data")
+
     id: int
     json_data: dict
 
 
 @dataclass
 class User:
+    __slots__ = ("id", "display_name")
+
     id: int
     display_name: str
 
 
 @dataclass
 class Highlight:
+    __slots__ = ("id", "name", "creator", "location", "sport")
+
     id: int
     name: str
     creator: User
     location: Location
     sport: str
-    latlong: str = field(init=False)
 
-    def __post_init__(self):
-        self.latlong = f'{self.location.latitude},{self.location.longitude}'
+    @property
+    def latlong(self) -> str:
+        """Returns the location of the highlight in `lat,lng` format.
+
+        Returns:
+            str: Latitude and longitude, separated by a comma
+        """
+        return f'{self.location.latitude},{self.location.longitude}'
 
 @dataclass
 class QueryFilter:
@@ -175,67 +267,176 @@ class QueryFilter:
     max_distance: int = None
 
 
-class BasicAuthToken(requests.auth.AuthBase):
-    def __init__(self, key, value):
-        self.key = key
-        self.value = value
+def _json(r):
+    """Parses the JSON body of response `r` with the fastest available parser.
 
-    def __call__(self, r):
-        authstr = "Basic " + base64.b64encode(
-            bytes(self.key + ":" + self.value, "utf-8")
-        ).decode("utf-8")
-        r.headers["Authorization"] = authstr
-        return r
+    Unlike `requests.Response.json()`, callers are expected to parse a response
+    only once and keep the result. An empty body, e.g. of a `204 No Content`
+    response, is returned as an empty dict without invoking the parser.
+    """
+    content = r.content
+    if not content:
+        return {}
+    return _loads(content)
+
+
+def _basic_auth(key, value):
+    """Returns the value of a HTTP basic `Authorization` header.
+
+    Unlike `requests`, which encodes credentials as latin-1, the credentials
+    are encoded as UTF-8.
+    """
+    credentials = bytes(key + ":" + value, "utf-8")
+    return "Basic " + base64.b64encode(credentials).decode("utf-8")
 
 
 class KomootApi:
     def __init__(self):
         self.user_id = ""
         self.token = ""
+        self._auth_header = ""
+
+        # share one session between all requests so connections to the komoot
+        # API are kept alive and reused instead of re-doing the TCP and TLS
+        # handshake for every call. Transient errors are retried with backoff.
+        self.session = requests.Session()
+        # ask for compressed responses. urllib3 lists brotli (and zstd) only if
+        # a decoder for it is installed, e.g. with the `fast` extra.
+        self.session.headers.update({"Accept-Encoding": ACCEPT_ENCODING})
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", adapter)
 
-    def __build_header(self):
-        if self.user_id != "" and self.token != "":
-            return {
-                "Authorization": "Basic {0}".format(
-                    base64.b64encode(
-                        bytes(self.user_id + ":" + self.token, "utf-8")
-                    ).decode()
-                )
-            }
-        return {}
+        self.tour_cache = TourCache()
 
-    @staticmethod
-    def __send_request(url, auth, params=None):
+        # many tours share the same highlights, keep the highlights and their
+        # tips in memory so each one is only requested once. Keyed by the
+        # highlight id as string.
+        self._highlight_cache = {}
+        self._tips_cache = {}
+
+    def __send_request(self, url, params=None, headers=None, stream=False):
         if not params:
             params = {}
         try:
-            r = requests.get(url, params=params, auth=auth)
+            r = self.session.get(
+                url,
+                params=params,
+                headers=headers,
+                stream=stream,
+                timeout=REQUEST_TIMEOUT,
+            )
             r.raise_for_status()
         except HTTPError as exc:
             code = exc.response.status_code
             if code == 403:
                 # oops, we hit a private profile our tour
                 # and are not permissioned to view
-                # TODO: add log message
-                pass
+                logger.warning("Access to '%s' denied.", url)
             else:
                 raise
 
         return r
 
+    def __fetch_pages(self, uri, params=None):
+        """Yields the parsed JSON body of every page of a paginated endpoint,
+        in page order.
+
+        The first page is requested on its own to learn `page.totalPages`. The
+        following pages are then prefetched concurrently using the `page` query
+        parameter while the caller processes the current one, but never more
+        than `PAGE_WORKERS` pages ahead. If the response does not report the
+        number of pages, the `_links.next` links are followed instead,
+        requesting each next page while the caller processes the current one.
+
+        Args:
+            uri (str): URI of the first page.
+            params (dict, optional): Query parameters sent with every page.
+                Defaults to None.
+
+        Yields:
+            dict: JSON body of a result page.
+        """
+        params = dict(params) if params else {}
+
+        def fetch_page(page_uri, page_params):
+            return _json(self.__send_request(page_uri, params=page_params))
+
+        response = fetch_page(uri, params)
+
+        total_pages = response.get("page", {}).get("totalPages")
+        if total_pages is not None and total_pages < 2:
+            yield response
+            return
+
+        # pages that haven't been requested yet are cancelled if the caller
+        # stops early, and the generator doesn't wait for the ones in flight
+        executor = ThreadPoolExecutor(max_workers=PAGE_WORKERS)
+        try:
+            if total_pages is not None:
+                pages = iter(range(1, total_pages))
+                pending = deque(
+                    executor.submit(fetch_page, uri, {**params, "page": page})
+                    for page in islice(pages, PAGE_WORKERS)
+                )
+                yield response
+                while pending:
+                    response = pending.popleft().result()
+                    # top the window up again before handing the page over
+                    for page in islice(pages, 1):
+                        pending.append(
+                            executor.submit(fetch_page, uri, {**params, "page": page})
+                        )
+                    yield response
+                return
+
+            # no page count available, follow the links to the next page
+            while True:
+                links = response.get("_links", {})
+                if "next" not in links or "href" not in links["next"]:
+                    yield response
+                    return
+                next_page = executor.submit(fetch_page, links["next"]["href"], params)
+                yield response
+                response = next_page.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
     def login(self, email, password):
+        logger.info("Logging in...")
 
         r = self.__send_request(
-            "https://api.komoot.de/v006/account/email/" + email + "/",
-            BasicAuthToken(email, password),
+            f"{API_V6}/account/email/{email}/",
+            headers={"Authorization": _basic_auth(email, password)},
         )
 
-        self.user_id = r.json()["username"]
-        self.token = r.json()["password"]
+        account = _json(r)
+        self.user_id = account["username"]
+        self.token = account["password"]
+
+        # the credentials don't change after logging in, so build the
+        # authorization header once and send it with every request of the
+        # session instead of encoding it again for each request.
+        self._auth_header = _basic_auth(self.user_id, self.token)
+        self.session.headers["Authorization"] = self._auth_header
+
+        # private highlights depend on the logged in user
+        self._highlight_cache.clear()
+        self._tips_cache.clear()
 
-    def fetch_tours(self, tour_user_id=None, queryfilter=None) -> dict[TourDetails]:
-        """Fetches all tours from a user. Tours can be filtered by passing a
-        `QueryFilter` instance to the `queryfilter` argument.
+    def iter_tours(
+        self, tour_user_id=None, queryfilter=None, details=True
+    ) -> typing.Iterator[TourDetails]:
+        """Yields all tours of a user, page by page. Tours can be filtered
+        by passing a `QueryFilter` instance to the `queryfilter` argument.
 
         Valid values for the `QueryFilter` instance:
         - type: [str] `tour_planned`, `tour_recorded`. Default: `None`, i.e. fetches
@@ -260,20 +461,29 @@ class KomootApi:
                 Defaults to None.
             queryfilter (QueryFilter, optional): `QueryFilter` instance to filter the
                 returned results. Defaults to None.
-
-        Returns:
-            dict[TourDetails]: A dictionary of `TourDetails` instances,
-                with the tour id as key.
+            details (bool, optional): Convert the tours to `TourDetails`. If
+                False, the tour data returned by komoot is stored as is, which
+                is cheaper if only the tour ids are needed. Defaults to True.
+
+        Yields:
+            TourDetails: The tours of the user, or the raw tour data if `details`
+                is False. Besides the page currently read, at most
+                `PAGE_WORKERS` prefetched pages are held in memory.
         """
 
         # define the parameters to pass to the komoot API query for tours.
         # if no queryfilter object is passed, use an empty dict.
         # If a queryfilter instance is passed, convert to dict as the requests parameter
-        # is a dictionary
+        # is a dictionary. Unset filters are left out; unlike `asdict` this
+        # doesn't deep copy the field values.
         if not queryfilter:
             params = {}
         else:
-            params = asdict(queryfilter)
+            params = {
+                f.name: getattr(queryfilter, f.name)
+                for f in fields(queryfilter)
+                if getattr(queryfilter, f.name) is not None
+            }
 
         # if a different user than the logged in one is specified, it is mandatory
         # to set the `status` parameter of the request to `public`.
@@ -283,25 +493,23 @@ class KomootApi:
         else:
             tour_user_id = self.user_id
 
-        results = {}
-        has_next_page = True
-        current_uri = "https://api.komoot.de/v007/users/" + tour_user_id + "/tours/"
-        while has_next_page:
-            r = self.__send_request(
-                current_uri, BasicAuthToken(self.user_id, self.token), params
-            )
-            response = r.json()
-
-            # check if any results found; if no results exit and return
-            # an empty dict.
-            total_elements = response["page"]["totalElements"]
-            if total_elements == 0:
+        logger.info("Fetching tours of user '%s'...", tour_user_id)
+        current_uri = f"{API_V7}/users/{tour_user_id}/tours/"
+        for page, response in enumerate(self.__fetch_pages(current_uri, params)):
+            # check if any results found; if no results stop without
+            # yielding anything. The total is the same on every page, so only the
+            # first one needs to be checked.
+            if page == 0 and response.get("page", {}).get("totalElements", 0) == 0:
                 break
 
-            # process tours that were found and add to results
+            # process tours that were found
             tours = response["_embedded"]["tours"]
+            if not details:
+                yield from tours
+                continue
+
             for tour in tours:
-                results[tour["id"]] = TourDetails(
+                yield TourDetails(
                     tour["id"],
                     tour["name"],
                     # Python 3.11 datetime.fromisoformat recognizes iso strings
@@ -319,44 +527,96 @@ class KomootApi:
                     tour["_embedded"]["creator"]["display_name"],
                 )
 
-            # check if there is a next page link, if yes process
-            # the link in the next iteration
-            has_next_page = (
-                "next" in response["_links"] and "href" in response["_links"]["next"]
-            )
-            if has_next_page:
-                current_uri = response["_links"]["next"]["href"]
+    def fetch_tours(
+        self, tour_user_id=None, queryfilter=None, details=True
+    ) -> dict[TourDetails]:
+        """Fetches all tours from a user. Takes the same arguments as
+        `iter_tours`.
 
-        return results
+        Returns:
+            dict[TourDetails]: A dictionary of `TourDetails` instances (or of the
+                raw tour data if `details` is False), with the tour id as key.
+        """
+        tours = self.iter_tours(tour_user_id, queryfilter, details)
+        if not details:
+            return {tour["id"]: tour for tour in tours}
+        return {tour.id: tour for tour in tours}
 
     def print_tours(self, tours):
         print()
-        for tour_id in tours:
-            print(tours[tour_id])
+        for tour in tours.values():
+            print(tour)
 
         if len(tours) < 1:
             print("No tours found on profile.")
 
-    def fetch_tour(self, tour_id):
+    def fetch_tour(self, tour_id, full_embed=False):
+        """Fetches the details and coordinates of a tour.
 
-        # some of these query parameters are no longer supported.
-        # The only supported ones are in _embedded:
-        # coordinates, way_types, surfaces, directions, participants
-        # Not supported:
-        # timeline, directions, fields, format, timeline_highlights_fields, recommenders
-        r = self.__send_request(
-            "https://api.komoot.de/v007/tours/"
-            + tour_id
-            + "?_embedded=coordinates,way_types,"
-            "surfaces,directions,participants,"
-            "timeline&directions=v2&fields"
-            "=timeline&format=coordinate_array"
-            "&timeline_highlights_fields=tips,"
-            "recommenders",
-            BasicAuthToken(self.user_id, self.token),
-        )
+        By default only the data used by `GpxCompiler` is requested, i.e. the
+        tour itself and its coordinates. Way types, surfaces, directions,
+        participants and the timeline inflate the response by a multiple and
+        are only requested if `full_embed` is set.
+
+        Args:
+            tour_id (int): Id of the tour.
+            full_embed (bool, optional): Also request way types, surfaces,
+                directions, participants and the timeline. Defaults to False.
 
-        return Tour(tour_id, r.json())
+        Returns:
+            Tour: `Tour` instance with the JSON data returned by komoot, or
+                None if access to the tour was denied.
+        """
+        if full_embed:
+            uri = TOUR_URL_FULL_EMBED.format(tour_id)
+            cache_key = f"{tour_id}-full"
+        else:
+            uri = TOUR_URL.format(tour_id)
+            cache_key = f"{tour_id}"
+
+        logger.info("Fetching tour '%s'...", tour_id)
+
+        # the tour data is cached on disk together with its ETag. If the tour
+        # has not changed since it was cached, komoot answers with
+        # `304 Not Modified` and the cached data is used.
+        etag, cached = self.tour_cache.load(cache_key)
+        headers = {"If-None-Match": etag} if etag else None
+
+        # the response is streamed and read from the socket in one go, so the
+        # gzip encoded body is decompressed while it arrives instead of being
+        # collected in small chunks first.
+        with self.__send_request(uri, headers=headers, stream=True) as r:
+            if r.status_code == 304 and cached is not None:
+                logger.info("Tour '%s' not modified, using cached data", tour_id)
+                return Tour(tour_id, _loads(cached))
+            if not r.ok:
+                return None
+
+            body = r.raw.read(decode_content=True)
+
+        if r.status_code == 200 and "ETag" in r.headers:
+            self.tour_cache.store(cache_key, r.headers["ETag"], body)
+
+        return Tour(tour_id, _loads(body))
+
+    def fetch_tours_bulk(self, tour_ids, full_embed=False) -> dict[Tour]:
+        """Fetches several tours concurrently.
+
+        Args:
+            tour_ids (Iterable): Ids of the tours to fetch.
+            full_embed (bool, optional): Passed on to `fetch_tour`.
+                Defaults to False.
+
+        Returns:
+            dict[Tour]: A dictionary of `Tour` instances, with the tour id as key.
+                The value is None for tours that access was denied to.
+        """
+        tour_ids = list(tour_ids)
+        with ThreadPoolExecutor(max_workers=TOUR_WORKERS) as executor:
+            tours = executor.map(
+                lambda tour_id: self.fetch_tour(tour_id, full_embed), tour_ids
+            )
+            return dict(zip(tour_ids, tours))
 
     def fetch_tour_gpx(self, tour_id: int) -> str:
         """Fetch the gpx track of a given tour.
@@ -399,41 +659,58 @@ class KomootApi:
         """
         params = {}
 
-        uri = f"https://api.komoot.de/v007/tours/{tour_id}.gpx"
-        r = self.__send_request(uri, BasicAuthToken(self.user_id, self.token), params)
+        logger.info("Fetching GPX track of tour '%s'...", tour_id)
+        uri = f"{API_V7}/tours/{tour_id}.gpx"
+        r = self.__send_request(uri, params=params)
 
         return r.text
 
-    def fetch_highlight_tips(self, highlight_id):
+    def write_tour_gpx(self, tour_id: int, fileobj: typing.BinaryIO) -> None:
+        """Stream the gpx track of a given tour into a binary file object.
 
-        r = self.__send_request(
-            "https://api.komoot.de/v007/highlights/" + highlight_id + "/tips/",
-            BasicAuthToken(self.user_id, self.token),
-            critical=False,
-        )
+        Same track as returned by `fetch_tour_gpx`, but the response is written
+        to `fileobj` in chunks as it arrives instead of being decoded and held
+        in memory as a whole.
 
-        return r.json()
+        Args:
+            tour_id (int): Id of the tour.
+            fileobj (typing.BinaryIO): File object opened in binary mode
+                (`"wb"`) the GPX track is written to.
 
-    def fetch_recommenders(self, highlight_id):
-        params = {}
+        Returns:
+            bool: True if the track was written, False if access to the tour
+                was denied and nothing was written.
+        """
+        logger.info("Fetching GPX track of tour '%s'...", tour_id)
+        uri = f"{API_V7}/tours/{tour_id}.gpx"
+        r = self.__send_request(uri, stream=True)
+
+        with r:
+            # don't write the error body of a denied request as GPX track
+            if not r.ok:
+                return False
+            for chunk in r.iter_content(GPX_CHUNK_SIZE):
+                fileobj.write(chunk)
+        return True
 
-        results = {}
-        has_next_page = True
-        current_uri = (
-            f"https://api.komoot.de/v007/highlights/{highlight_id}/recommenders/"
-        )
-        while has_next_page:
-            r = self.__send_request(
-                current_uri, BasicAuthToken(self.user_id, self.token), params
-            )
+    def fetch_highlight_tips(self, highlight_id):
+        key = str(highlight_id)
+        if key in self._tips_cache:
+            return self._tips_cache[key]
 
-            has_next_page = (
-                "next" in r.json()["_links"] and "href" in r.json()["_links"]["next"]
-            )
-            if has_next_page:
-                current_uri = r.json()["_links"]["next"]["href"]
+        logger.info("Fetching tips of highlight '%s'...", key)
+        r = self.__send_request(f"{API_V7}/highlights/{key}/tips/")
+
+        tips = _json(r)
+        self._tips_cache[key] = tips
+        return tips
 
-            recommenders = r.json()["_embedded"]["items"]
+    def fetch_recommenders(self, highlight_id):
+        logger.info("Fetching recommenders of highlight '%s'...", highlight_id)
+        results = {}
+        current_uri = f"{API_V7}/highlights/{highlight_id}/recommenders/"
+        for response in self.__fetch_pages(current_uri):
+            recommenders = response.get("_embedded", {}).get("items", [])
             for recommender in recommenders:
                 # get only public profiles
                 if recommender["status"] != "public":
@@ -445,12 +722,17 @@ class KomootApi:
         return results
 
     def fetch_highlight(self, highlight_id):
+        key = str(highlight_id)
+        if key in self._highlight_cache:
+            return self._highlight_cache[key]
+
+        logger.info("Fetching highlight '%s'...", key)
         params = {}
 
-        uri = f"https://api.komoot.de/v007/highlights/{highlight_id}/"
-        r = self.__send_request(uri, BasicAuthToken(self.user_id, self.token), params)
+        uri = f"{API_V7}/highlights/{highlight_id}/"
+        r = self.__send_request(uri, params=params)
 
-        highlight = r.json()
+        highlight = _json(r)
         result = Highlight(
             highlight["id"],
             highlight["name"],
@@ -466,4 +748,5 @@ class KomootApi:
             highlight["sport"],
         )
 
+        self._highlight_cache[key] = result
         return result
@@ -0,0 +1,101 @@
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# set this environment variable to `1` to bypass the on-disk tour cache
+NOCACHE_ENV = "KOMOOTGPX_NOCACHE"
+
+
+def default_cache_dir() -> str:
+    """Returns the directory used to cache tour data, honouring
+    `XDG_CACHE_HOME` if it is set.
+
+    Returns:
+        str: Path of the cache directory, e.g. `~/.cache/komootgpx/tours`
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "komootgpx", "tours")
+
+
+class TourCache:
+    """On-disk cache for the JSON data of tours.
+
+    The raw response body of a tour is stored as `{key}.json` next to the
+    `ETag` the komoot API returned for it in `{key}.etag`. The ETag is sent
+    as `If-None-Match` on the next request for the tour, so an unchanged tour
+    is answered with `304 Not Modified` and read from disk instead.
+
+    The cache is disabled if the `KOMOOTGPX_NOCACHE` environment variable
+    is set to `1`.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.enabled = os.environ.get(NOCACHE_ENV) != "1"
+
+    def __paths(self, key):
+        base = os.path.join(self.cache_dir, str(key))
+        return base + ".json", base + ".etag"
+
+    def load(self, key) -> tuple[str, bytes]:
+        """Returns the cached ETag and body for `key`.
+
+        Args:
+            key (str): Cache key, usually the tour id.
+
+        Returns:
+            tuple[str, bytes]: ETag and raw JSON body, or `(None, None)` if
+                nothing is cached for `key`.
+        """
+        if not self.enabled:
+            return None, None
+
+        body_path, etag_path = self.__paths(key)
+        try:
+            with open(etag_path, "r", encoding="utf-8") as f:
+                etag = f.read()
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except OSError:
+            return None, None
+
+        return etag, body
+
+    def store(self, key, etag, body):
+        """Stores the ETag and raw body of a response for `key`.
+
+        Both files are written to a temporary file first and then moved into
+        place, so a concurrent or interrupted run never reads a partial file.
+        Errors writing the cache are logged and otherwise ignored.
+
+        Args:
+            key (str): Cache key, usually the tour id.
+            etag (str): ETag header of the response.
+            body (bytes): Raw JSON body of the response.
+        """
+        if not self.enabled:
+            return
+
+        body_path, etag_path = self.__paths(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write the body before the etag, so an etag on disk always
+            # belongs to a complete body
+            self.__write_atomic(body_path, body)
+            self.__write_atomic(etag_path, etag.encode("utf-8"))
+        except OSError as exc:
+            # the cache is only an optimisation, a cache directory that can't
+            # be written must not fail the download
+            logger.warning("Could not cache '%s': %s", key, exc)
+
+    def __write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -1,28 +1,21 @@
 from datetime import datetime, timedelta
 
 import gpxpy.gpx
+import gpxpy.gpxfield
+import gpxpy.utils
 
+# how gpxpy serialises the track segment of a tour before points are added
+EMPTY_SEGMENT = "<trkseg>\n    </trkseg>"
 
-class Point:
-    CONST_UNDEFINED = -9999
+try:
+    import orjson
 
-    def __init__(self, json):
-        self.lat = self.lng = self.time = self.alt = self.CONST_UNDEFINED
+    def _format_time(time):
+        # same output as `gpxpy.gpxfield.format_time`, but formatted in C
+        return orjson.dumps(time, option=orjson.OPT_UTC_Z)[1:-1].decode()
 
-        if "lat" not in json and "lng" not in json:
-            return
-        self.lat = json["lat"]
-        self.lng = json["lng"]
-        if "alt" in json:
-            self.alt = json["alt"]
-        if "t" in json:
-            self.time = json["t"]
-
-    def is_empty(self):
-        return self.lat == self.CONST_UNDEFINED and self.lng == self.CONST_UNDEFINED
-
-    def has_only_coords(self):
-        return self.alt == self.CONST_UNDEFINED and self.time == self.CONST_UNDEFINED
+except ImportError:
+    _format_time = gpxpy.gpxfield.format_time
 
 
 class POI:
@@ -49,34 +42,38 @@ class GpxCompiler:
     def __init__(self, tour):
         self.tour = tour
 
-        self.route = []
-        for coord in tour["_embedded"]["coordinates"]["items"]:
-            self.route.append(Point(coord))
+    def __build_gpx(self):
+        """Builds the GPX document with the tour metadata and a single, still
+        empty track segment.
+
+        Returns:
+            tuple[GPX, GPXTrackSegment]: The document and its track segment.
+        """
+        tour = self.tour
+        creator = tour["_embedded"]["creator"]
+        creator_name = creator["display_name"]
 
-    def generate(self):
         gpx = gpxpy.gpx.GPX()
-        gpx.name = self.tour["name"]
-        if self.tour["type"] == "tour_recorded":
+        gpx.name = tour["name"]
+        if tour["type"] == "tour_recorded":
             gpx.name = gpx.name + " (Completed)"
         gpx.description = (
-            f"Distance: {str(int(self.tour['distance']) / 1000.0)}km, "
-            f"Estimated duration: {timedelta(seconds=self.tour['duration'])}hrs, "
-            f"Elevation up: {self.tour['elevation_up']}m, "
-            f"Elevation down: {self.tour['elevation_down']}m"
+            f"Distance: {str(int(tour['distance']) / 1000.0)}km, "
+            f"Estimated duration: {timedelta(seconds=tour['duration'])}hrs, "
+            f"Elevation up: {tour['elevation_up']}m, "
+            f"Elevation down: {tour['elevation_down']}m"
         )
-        if "difficulty" in self.tour:
+        if "difficulty" in tour:
             gpx.description = (
-                gpx.description + f", Grade: {self.tour['difficulty']['grade']}"
+                gpx.description + f", Grade: {tour['difficulty']['grade']}"
             )
 
-        gpx.author_name = self.tour["_embedded"]["creator"]["display_name"]
-        gpx.author_link = "https://www.komoot.de/user/" + str(
-            self.tour["_embedded"]["creator"]["username"]
-        )
-        gpx.author_link_text = "View " + gpx.author_name + "'s Profile on Komoot"
-        gpx.link = "https://www.komoot.de/tour/" + str(self.tour["id"])
+        gpx.author_name = creator_name
+        gpx.author_link = "https://www.komoot.de/user/" + str(creator["username"])
+        gpx.author_link_text = "View " + creator_name + "'s Profile on Komoot"
+        gpx.link = "https://www.komoot.de/tour/" + str(tour["id"])
         gpx.link_text = "View tour on Komoot"
-        gpx.creator = self.tour["_embedded"]["creator"]["display_name"]
+        gpx.creator = creator_name
 
         track = gpxpy.gpx.GPXTrack()
         track.name = gpx.name
@@ -90,18 +87,79 @@ class GpxCompiler:
         segment = gpxpy.gpx.GPXTrackSegment()
         track.segments.append(segment)
 
-        augment_timestamp = self.route[0].time == 0
+        return gpx, segment
+
+    def __iter_points(self):
+        """Yields `(lat, lng, elevation, time)` for every coordinate of the tour.
+        Elevation and time are `None` if the coordinate doesn't have them.
+        """
+        coordinates = self.tour["_embedded"]["coordinates"]["items"]
+        if not coordinates:
+            return
+
+        # komoot either includes elevation and time for all coordinates of a
+        # tour or for none of them, so the first one decides. Tours with plain
+        # coordinates skip the per point lookups and timestamp handling.
+        first = coordinates[0]
+        if "alt" not in first and "t" not in first:
+            for coord in coordinates:
+                yield coord["lat"], coord["lng"], None, None
+            return
+
+        augment_timestamp = first.get("t") == 0
         start_date = datetime.strptime(self.tour["date"], "%Y-%m-%dT%H:%M:%S.%f%z")
 
-        for coord in self.route:
-            point = gpxpy.gpx.GPXTrackPoint(coord.lat, coord.lng)
-            if coord.alt != coord.CONST_UNDEFINED:
-                point.elevation = coord.alt
-            if coord.time != coord.CONST_UNDEFINED:
+        # the functions used per point are bound to locals to save the attribute
+        # lookups, and relative timestamps are added as integer milliseconds
+        # instead of dividing them into float seconds first.
+        td = timedelta
+        fromtimestamp = datetime.fromtimestamp
+        for coord in coordinates:
+            time = coord.get("t")
+            if time is not None:
                 if augment_timestamp:
-                    point.time = start_date + timedelta(seconds=coord.time / 1000)
+                    time = start_date + td(milliseconds=time)
                 else:
-                    point.time = datetime.fromtimestamp(coord.time / 1000)
-            segment.points.append(point)
+                    time = fromtimestamp(time / 1000)
+            yield coord["lat"], coord["lng"], coord.get("alt"), time
+
+    def generate(self):
+        gpx, segment = self.__build_gpx()
+
+        # build the track points in a single pass over the coordinates
+        points = segment.points
+        track_point = gpxpy.gpx.GPXTrackPoint
+        for lat, lng, alt, time in self.__iter_points():
+            points.append(track_point(lat, lng, elevation=alt, time=time))
 
         return gpx.to_xml()
+
+    def generate_to_stream(self, fileobj):
+        """Writes the same GPX document as `generate` to a text file object.
+
+        Only the metadata is serialised by gpxpy. The track points are
+        formatted and written one by one as they are read from the tour, so
+        no gpxpy object is created per point and memory use does not grow with
+        the length of the tour.
+
+        Args:
+            fileobj (typing.TextIO): File object opened in text mode the GPX
+                document is written to.
+        """
+        gpx, _ = self.__build_gpx()
+        head, tail = gpx.to_xml().rsplit(EMPTY_SEGMENT, 1)
+
+        write = fileobj.write
+        make_str = gpxpy.utils.make_str
+        format_time = _format_time
+        write(head)
+        write("<trkseg>")
+        for lat, lng, alt, time in self.__iter_points():
+            write(f'\n      <trkpt lat="{make_str(lat)}" lon="{make_str(lng)}">')
+            if alt is not None:
+                write(f"\n        <ele>{make_str(alt)}</ele>")
+            if time is not None:
+                write(f"\n        <time>{format_time(time)}</time>")
+            write("\n      </trkpt>")
+        write("\n    </trkseg>")
+        write(tail)
@@ -1,4 +1,8 @@
 import getpass
+import re
+
+# characters that are not allowed in file names on Windows, macOS or Linux
+_FILENAME_FORBIDDEN = re.compile(r'[\\/:*?"<>|]')
 
 
 class bcolor:
@@ -54,6 +58,4 @@ def prompt_pass(title):
 
 
 def sanitize_filename(value):
-    for c in '\\/:*?"<>|':
-        value = value.replace(c, "")
-    return value
+    return _FILENAME_FORBIDDEN.sub("", value)
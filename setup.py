@@ -30,6 +30,11 @@ setup(
         "requests>=2.25.1",
         "urllib3>=1.26.3",
     ],
-    setup_requires=["pytest", "flake8", "black"],
+    extras_require={
+        # tools used to test and lint the package, not needed to run it
+        "dev": ["pytest", "flake8", "black"],
+        # faster JSON parsing, and smaller, brotli compressed API responses
+        "fast": ["orjson", "brotli"],
+    },
     tests_require=["pytest"],
 )